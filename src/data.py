@@ -5,10 +5,42 @@ import xarray as xr
 import itertools
 import functools as ft
 import tqdm
+import warnings
+import weakref
+from multiprocessing import shared_memory, resource_tracker
 from collections import namedtuple
 
 TrainingItem = namedtuple('TrainingItem', ['input', 'tgt'])
 
+try:
+    import numba
+
+    @numba.njit(cache=True)
+    def _extract_patch_4d(arr, t0, y0, x0, pt, py, px):
+        return arr[:, t0:t0 + pt, y0:y0 + py, x0:x0 + px].copy()
+except ImportError:
+    _extract_patch_4d = None
+
+def combine_limits(limits, other):
+    """
+    merge two selection dicts, intersecting slices on shared dims to match
+    the semantics of nested .sel calls
+    """
+    out = dict(limits)
+    for dim, sel in other.items():
+        cur = out.get(dim)
+        if cur is None:
+            out[dim] = sel
+        elif isinstance(cur, slice) and isinstance(sel, slice):
+            out[dim] = slice(
+                max((v for v in (cur.start, sel.start) if v is not None), default=None),
+                min((v for v in (cur.stop, sel.stop) if v is not None), default=None),
+                cur.step if sel.step is None else sel.step,
+            )
+        else:
+            raise ValueError(f"conflicting non-slice selections on dim {dim}")
+    return out
+
 class IncompleteScanConfiguration(Exception):
     pass
 
@@ -33,19 +65,33 @@ class XrDataset(torch.utils.data.Dataset):
     def __init__(
             self, da, patch_dims, domain_limits=None, strides=None,
             check_full_scan=False, check_dim_order=False,
-            postpro_fn=None
+            postpro_fn=None, preload=True, shared_mem=False
             ):
         """
         da: xarray.DataArray with patch dims at the end in the dim orders
-        patch_dims: dict of da dimension to size of a patch 
+        patch_dims: dict of da dimension to size of a patch
         domain_limits: dict of da dimension to slices of domain to select for patch extractions
         strides: dict of dims to stride size (default to one)
         check_full_scan: Boolean: if True raise an error if the whole domain is not scanned by the patch size stride combination
+        preload: Boolean: if True eagerly load the selected domain as one contiguous float32 buffer, else keep the (possibly lazy) backing array
+        shared_mem: Boolean: if True put the preloaded buffer in posix shared memory so dataloader workers map the same pages instead of copying it
         """
         super().__init__()
         self.return_coords = False
         self.postpro_fn = postpro_fn
-        self.da = da.sel(**(domain_limits or {}))
+        domain_limits = domain_limits or {}
+        # translate label slices to integer slices upfront, one cheap isel
+        # instead of paying the label-indexing tax on every setup
+        sel_limits = {d: s for d, s in domain_limits.items()
+                      if not (isinstance(s, slice) and d in da.indexes)}
+        isel_limits = {d: da.indexes[d].slice_indexer(s.start, s.stop, s.step)
+                       for d, s in domain_limits.items()
+                       if isinstance(s, slice) and d in da.indexes}
+        self.da = da
+        if sel_limits:
+            self.da = self.da.sel(**sel_limits)
+        if isel_limits:
+            self.da = self.da.isel(**isel_limits)
         self.patch_dims = patch_dims
         self.strides = strides or {}
         da_dims = dict(zip(self.da.dims, self.da.shape))
@@ -54,6 +100,40 @@ class XrDataset(torch.utils.data.Dataset):
             for dim in patch_dims
         }
 
+        # precomputed index tables so that __getitem__ only does integer arithmetic
+        self._dims = tuple(patch_dims)
+        self._strides_t = tuple(self.strides.get(d, 1) for d in self._dims)
+        self._patch_t = tuple(patch_dims[d] for d in self._dims)
+        self._shape_t = tuple(self.ds_size[d] for d in self._dims)
+        divs = []
+        div = 1
+        for n in reversed(self._shape_t):
+            divs.append(div)
+            div *= n
+        self._divs = tuple(reversed(divs))
+        self._len = int(np.prod(self._shape_t, dtype=np.int64))
+
+        # raw array view so the hot path skips xarray indexing
+        self._shm = None
+        if preload:
+            self._arr = np.ascontiguousarray(self.da.values, dtype=np.float32)
+            if shared_mem:
+                shm = shared_memory.SharedMemory(create=True, size=self._arr.nbytes)
+                shm_arr = np.ndarray(self._arr.shape, dtype=np.float32, buffer=shm.buf)
+                np.copyto(shm_arr, self._arr)
+                self._arr, self._shm = shm_arr, shm
+                # owning process unlinks the segment when the dataset dies
+                weakref.finalize(self, self._release_shm, shm, unlink=True)
+        else:
+            self._arr = self.da.data
+        self._leading = self._arr.ndim - len(patch_dims)
+        self._use_jit = (
+            _extract_patch_4d is not None
+            and isinstance(self._arr, np.ndarray)
+            and self._arr.ndim == 4
+            and self._leading == 1
+        )
+
 
         if check_full_scan:
             for dim in patch_dims:
@@ -78,17 +158,67 @@ class XrDataset(torch.utils.data.Dataset):
                         patch_dims {list(patch_dims)}
                         """
                 )
+    @staticmethod
+    def _release_shm(shm, unlink):
+        shm.close()
+        if unlink:
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+
+    def __getstate__(self):
+        # ship the shared memory name instead of the buffer so workers reattach
+        state = self.__dict__.copy()
+        if self._shm is not None:
+            state['_shm'] = None
+            state['_arr'] = None
+            state['_shm_meta'] = (self._shm.name, self._arr.shape)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        meta = self.__dict__.pop('_shm_meta', None)
+        if meta is not None:
+            name, shape = meta
+            shm = shared_memory.SharedMemory(name=name)
+            try:
+                # attached copies must not let the resource tracker unlink the
+                # segment out from under the owning process at worker exit
+                resource_tracker.unregister(shm._name, 'shared_memory')
+            except Exception:
+                pass
+            self._shm = shm
+            self._arr = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+            weakref.finalize(self, self._release_shm, shm, unlink=False)
+
     def __len__(self):
-        size = 1
-        for v in self.ds_size.values():
-            size *= v
-        return size
+        return self._len
 
     def __iter__(self):
         for i in range(len(self)):
             yield self[i]
 
+    def _patch_starts(self, item):
+        starts = []
+        for div, stride in zip(self._divs, self._strides_t):
+            idx, item = divmod(item, div)
+            starts.append(stride * idx)
+        return tuple(starts)
+
+    def iter_patch_slices(self):
+        for i in range(len(self)):
+            yield {
+                    d: slice(start, start + p)
+                    for d, start, p in zip(self._dims, self._patch_starts(i), self._patch_t)
+                    }
+
     def get_coords(self):
+        """kept for compatibility, prefer iter_patch_slices which stays lazy"""
+        warnings.warn(
+                "get_coords materializes coords for every patch, use iter_patch_slices",
+                DeprecationWarning,
+        )
         self.return_coords = True
         coords = []
         try:
@@ -99,22 +229,52 @@ class XrDataset(torch.utils.data.Dataset):
             return coords
 
     def __getitem__(self, item):
-        sl = {
-                dim: slice(self.strides.get(dim, 1) * idx,
-                           self.strides.get(dim, 1) * idx + self.patch_dims[dim])
-                for dim, idx in zip(self.ds_size.keys(),
-                                    np.unravel_index(item, tuple(self.ds_size.values())))
-                }
-        item =  self.da.isel(**sl)
-
+        starts = self._patch_starts(item)
         if self.return_coords:
-            return item.coords.to_dataset()[list(self.patch_dims)]
-
-        item = item.data.astype(np.float32)
+            sl = {
+                    d: slice(start, start + p)
+                    for d, start, p in zip(self._dims, starts, self._patch_t)
+                    }
+            return self.da.isel(**sl).coords.to_dataset()[list(self.patch_dims)]
+
+        if self._use_jit:
+            item = _extract_patch_4d(self._arr, *starts, *self._patch_t)
+        else:
+            sl = (slice(None),) * self._leading + tuple(
+                    slice(start, start + p)
+                    for start, p in zip(starts, self._patch_t)
+                    )
+            item = self._arr[sl]
+        item = np.asarray(item, dtype=np.float32)
         if self.postpro_fn is not None:
             return self.postpro_fn(item)
         return item
 
+    def __getitems__(self, indices):
+        """
+        batched fetch used by torch's _MapDatasetFetcher: slices all patches
+        of the batch from the underlying array in one vectorized operation
+        """
+        if not isinstance(self._arr, np.ndarray):
+            return [self[i] for i in indices]
+
+        idxs = np.asarray(indices, dtype=np.int64)
+        starts = []
+        rem = idxs
+        for div, stride in zip(self._divs, self._strides_t):
+            idx, rem = np.divmod(rem, div)
+            starts.append(idx * stride)
+
+        win = np.lib.stride_tricks.sliding_window_view(
+            self._arr, self._patch_t,
+            axis=tuple(range(self._leading, self._arr.ndim)),
+        )
+        batch = win[(slice(None),) * self._leading + tuple(starts)]
+        batch = np.moveaxis(batch, self._leading, 0).astype(np.float32)
+        if self.postpro_fn is not None:
+            return [self.postpro_fn(it) for it in batch]
+        return list(batch)
+
     def reconstruct(self, batches, weight=None):
         """
         takes as input a list of np.ndarray of dimensions (b, *, *patch_dims)
@@ -125,37 +285,41 @@ class XrDataset(torch.utils.data.Dataset):
         overlapping patches will be averaged with weighting 
         """
 
-        items = list(itertools.chain(*batches))
+        items = itertools.chain.from_iterable(
+                np.asarray(b, dtype=np.float32) for b in batches)
         return self.reconstruct_from_items(items, weight)
 
     def reconstruct_from_items(self, items, weight=None):
+        """
+        items: iterable of arrays in dataset order, consumed lazily one patch at a time
+        """
         if weight is None:
-            weight = np.ones(list(self.patch_dims.values()))
-        w = xr.DataArray(weight, dims=list(self.patch_dims.keys()))
-
-        coords = self.get_coords()
-
-        new_dims = [f'v{i}' for i in range(len(items[0].shape) - len(coords[0].dims))]
-        dims = new_dims + list(coords[0].dims)
-
-        das = [xr.DataArray(it.numpy(), dims=dims, coords=co.coords)
-               for  it, co in zip(items, coords)]
-
-        da_shape = dict(zip(coords[0].dims, self.da.shape[-len(coords[0].dims):]))
-        new_shape = dict(zip(new_dims, items[0].shape[:len(new_dims)]))
-
-        rec_da = xr.DataArray(
-                np.zeros([*new_shape.values(), *da_shape.values()]),
-                dims=dims,
-                coords={d: self.da[d] for d in self.patch_dims} 
+            weight = np.ones(self._patch_t)
+        weight = np.asarray(weight, dtype=np.float32)
+
+        items = iter(items)
+        first = next(items)
+        nv = len(first.shape) - len(self._dims)
+        new_dims = [f'v{i}' for i in range(nv)]
+        full_shape = tuple(first.shape[:nv]) + self.da.shape[-len(self._dims):]
+
+        rec = np.zeros(full_shape, dtype=np.float32)
+        cnt = np.zeros(full_shape, dtype=np.float32)
+        buf = np.empty(tuple(first.shape), dtype=np.float32)
+        for item_idx, it in enumerate(itertools.chain([first], items)):
+            sl = (slice(None),) * nv + tuple(
+                    slice(start, start + p)
+                    for start, p in zip(self._patch_starts(item_idx), self._patch_t)
+                    )
+            np.multiply(np.asarray(it), weight, out=buf)
+            rec[sl] += buf
+            cnt[sl] += weight
+
+        return xr.DataArray(
+                rec / cnt,
+                dims=[*new_dims, *self._dims],
+                coords={d: self.da[d] for d in self.patch_dims},
         )
-        count_da = xr.zeros_like(rec_da)
-
-        for da in das:
-            rec_da.loc[da.coords] = rec_da.sel(da.coords) + da * w
-            count_da.loc[da.coords] = count_da.sel(da.coords) + w
-
-        return rec_da / count_da
 
 class XrConcatDataset(torch.utils.data.ConcatDataset):
     """
@@ -165,21 +329,64 @@ class XrConcatDataset(torch.utils.data.ConcatDataset):
         """
         Returns list of xarray object, reconstructed from batches
         """
-        items_iter = itertools.chain(*batches)
+        items_iter = itertools.chain.from_iterable(
+                np.asarray(b, dtype=np.float32) for b in batches)
         rec_das = []
         for ds in self.datasets:
-            ds_items = list(itertools.islice(items_iter, len(ds)))
-            rec_das.append(ds.reconstruct_from_items(ds_items, weight))
+            rec_das.append(ds.reconstruct_from_items(
+                itertools.islice(items_iter, len(ds)), weight))
     
         return rec_das
 
 class AugmentedDataset(torch.utils.data.Dataset):
-    def __init__(self, inp_ds, aug_factor, aug_only=False, noise_sigma=None):
+    def __init__(self, inp_ds, aug_factor, aug_only=False, noise_sigma=None, cache_size=0,
+                 precompute_masks=False):
         self.aug_factor = aug_factor
         self.aug_only = aug_only
         self.inp_ds = inp_ds
         self.perm = np.random.permutation(len(self.inp_ds))
+        # perm_powers[k] maps an index through the permutation k times
+        self.perm_powers = [np.arange(len(self.inp_ds))]
+        for _ in range(aug_factor):
+            self.perm_powers.append(self.perm[self.perm_powers[-1]])
         self.noise_sigma = noise_sigma
+        # opt-in: cached entries can be full patch copies, size this to a few
+        # batches per worker (~4 * batch_size * num_workers)
+        self.cache_size = min(len(inp_ds), cache_size)
+        # per-patch finite masks, bit-packed and filled on first touch
+        self._finite_masks = {}
+        self._init_cache()
+        if precompute_masks:
+            self._precompute_masks()
+
+    def _precompute_masks(self):
+        """build all finite masks upfront, across cores when joblib is installed"""
+        def pack(i):
+            return np.packbits(np.isfinite(self.inp_ds[i].input).ravel())
+
+        try:
+            from joblib import Parallel, delayed
+            masks = Parallel(n_jobs=-1, prefer='threads')(
+                    delayed(pack)(i) for i in range(len(self.inp_ds)))
+        except ImportError:
+            masks = [pack(i) for i in range(len(self.inp_ds))]
+        self._finite_masks = dict(enumerate(masks))
+
+    def _init_cache(self):
+        # each process (main or dataloader worker) gets its own LRU, see __setstate__
+        if self.cache_size:
+            self._get = ft.lru_cache(maxsize=self.cache_size)(self.inp_ds.__getitem__)
+        else:
+            self._get = self.inp_ds.__getitem__
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_get']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_cache()
 
     def __len__(self):
         return len(self.inp_ds) * (1 + self.aug_factor - int(self.aug_only))
@@ -189,22 +396,44 @@ class AugmentedDataset(torch.utils.data.Dataset):
             idx = idx + len(self.inp_ds)
 
         if idx < len(self.inp_ds):
-            return self.inp_ds[idx]
+            return self._get(idx)
 
-        tgt_idx = idx % len(self.inp_ds)
-        perm_idx = tgt_idx
-        for _ in range(idx // len(self.inp_ds)):
-            perm_idx = self.perm[perm_idx]
-        
-        item = self.inp_ds[tgt_idx]
-        perm_item = self.inp_ds[perm_idx]
+        k, tgt_idx = divmod(idx, len(self.inp_ds))
+        return self._augment(self._get(tgt_idx), self.perm_powers[k][tgt_idx])
 
-        noise = np.zeros_like(item.input, dtype=np.float32)
+    def __getitems__(self, indices):
+        n = len(self.inp_ds)
+        if self.aug_only:
+            indices = [idx + n for idx in indices]
+
+        ks, tgt_idxs = np.divmod(np.asarray(indices, dtype=np.int64), n)
+        perm_idxs = [self.perm_powers[k][t] if k > 0 else None
+                     for k, t in zip(ks, tgt_idxs)]
+
+        items = self._fetch(tgt_idxs.tolist())
+        return [item if perm_idx is None else self._augment(item, perm_idx)
+                for item, perm_idx in zip(items, perm_idxs)]
+
+    def _fetch(self, idxs):
+        getitems = getattr(self.inp_ds, '__getitems__', None)
+        if getitems is not None:
+            return getitems(idxs)
+        return [self._get(i) for i in idxs]
+
+    def _finite_mask(self, idx, ref):
+        packed = self._finite_masks.get(idx)
+        if packed is None:
+            packed = np.packbits(np.isfinite(self._get(idx).input).ravel())
+            self._finite_masks[idx] = packed
+        return np.unpackbits(packed, count=ref.size).view(bool).reshape(ref.shape)
+
+    def _augment(self, item, perm_idx):
+        out = np.array(item.tgt, dtype=np.float32, copy=True)
+        mask = self._finite_mask(perm_idx, out)
+        np.copyto(out, np.nan, where=~mask)
         if self.noise_sigma is not None:
-            noise = np.random.randn(*item.input.shape).astype(np.float32) * self.noise_sigma
-
-        return item._replace(input=noise + np.where(np.isfinite(perm_item.input),
-                             item.tgt, np.full_like(item.tgt,np.nan)))
+            out += np.random.randn(*out.shape).astype(np.float32) * self.noise_sigma
+        return item._replace(input=out)
 
 class BaseDataModule(pl.LightningDataModule):
     def __init__(self, input_da, domains, xrds_kw, dl_kw, aug_kw=None, norm_stats=None, **kwargs):
@@ -215,6 +444,7 @@ class BaseDataModule(pl.LightningDataModule):
         self.dl_kw = dl_kw
         self.aug_kw = aug_kw if aug_kw is not None else {}
         self._norm_stats = norm_stats
+        self._ns_tensors = None
 
         self.train_ds = None
         self.val_ds = None
@@ -232,40 +462,60 @@ class BaseDataModule(pl.LightningDataModule):
         return train_data.sel(variable=variable).pipe(lambda da: (da.mean().values.item(), da.std().values.item()))
 
     def post_fn(self):
-        m, s = self.norm_stats()
-        normalize = lambda item: (item - m) / s
-        return ft.partial(ft.reduce,lambda i, f: f(i), [
-            TrainingItem._make,
-            lambda item: item._replace(tgt=normalize(item.tgt)),
-            lambda item: item._replace(input=normalize(item.input)),
-        ])
+        # raw float32 patches, normalization happens on device in on_after_batch_transfer
+        return TrainingItem._make
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        # subclasses that override post_fn keep normalizing in the dataset
+        # (possibly per-field with their own stats), don't normalize twice
+        if type(self).post_fn is not BaseDataModule.post_fn:
+            return batch
+        if self._ns_tensors is None:
+            m, s = self.norm_stats()
+            self._ns_tensors = (
+                torch.tensor(m, device=batch.input.device),
+                torch.tensor(s, device=batch.input.device),
+            )
+        m, s = self._ns_tensors
+        return batch.__class__(*((x - m) / s for x in batch))
 
 
     def setup(self, stage='test'):
-        train_data = self.input_da.sel(self.domains['train'])
         post_fn = self.post_fn()
-        self.train_ds = XrDataset(
-            train_data, **self.xrds_kw, postpro_fn=post_fn,
-        )
+        xrds_kw = dict(self.xrds_kw)
+        domain_limits = xrds_kw.pop('domain_limits', None) or {}
+
+        def split_ds(split):
+            # single fused selection for the split domain and the domain limits
+            return XrDataset(
+                self.input_da, **xrds_kw,
+                domain_limits=combine_limits(dict(self.domains[split]), domain_limits),
+                postpro_fn=post_fn,
+            )
+
+        self.train_ds = split_ds('train')
         if self.aug_kw:
             self.train_ds = AugmentedDataset(self.train_ds, **self.aug_kw)
 
-        self.val_ds = XrDataset(
-            self.input_da.sel(self.domains['val']), **self.xrds_kw, postpro_fn=post_fn,
-        )
-        self.test_ds = XrDataset(
-            self.input_da.sel(self.domains['test']), **self.xrds_kw, postpro_fn=post_fn,
-        )
+        self.val_ds = split_ds('val')
+        self.test_ds = split_ds('test')
+
 
+    def _dl(self, ds, shuffle):
+        kw = dict(pin_memory=torch.cuda.is_available())
+        if self.dl_kw.get('num_workers', 0) > 0:
+            kw.update(persistent_workers=True, prefetch_factor=4)
+        kw.update(self.dl_kw)
+        return torch.utils.data.DataLoader(ds, shuffle=shuffle, **kw)
 
     def train_dataloader(self):
-        return  torch.utils.data.DataLoader(self.train_ds, shuffle=True, **self.dl_kw)
+        return self._dl(self.train_ds, shuffle=True)
 
     def val_dataloader(self):
-        return torch.utils.data.DataLoader(self.val_ds, shuffle=False, **self.dl_kw)
+        return self._dl(self.val_ds, shuffle=False)
 
     def test_dataloader(self):
-        return torch.utils.data.DataLoader(self.test_ds, shuffle=False, **self.dl_kw)
+        return self._dl(self.test_ds, shuffle=False)
 
 class ConcatDataModule(BaseDataModule):
     def train_mean_std(self):
@@ -162,6 +162,31 @@ def load_altimetry_data(path, obs_from_tgt=False):
         .to_array()
     )
 
+def load_zarr_data(path, obs_from_tgt=False):
+    """
+    Open a zarr store for lazy random patch access (pass preload=False to XrDataset).
+
+    Uses xarray-tensorstore when installed for its eager-indexing chunk cache,
+    falling back to xr.open_zarr. Random access is fastest when the store is
+    written with chunks matching the patch dims (chunks={dim: patch_dims[dim]})
+    so each patch maps to a single chunk read.
+    """
+    try:
+        import xarray_tensorstore
+        ds = xarray_tensorstore.open_zarr(path)
+    except ImportError:
+        ds = xr.open_zarr(path)
+
+    if obs_from_tgt:
+        ds = ds.assign(input=ds.tgt.where(np.isfinite(ds.input), np.nan))
+
+    return (
+        ds[[*src.data.TrainingItem._fields]]
+        .transpose("time", "lat", "lon")
+        .to_array()
+        .sortby('variable')
+    )
+
 def load_dc_data(**kwargs):
     path_gt="../sla-data-registry/NATL60/NATL/ref_new/NATL60-CJM165_NATL_ssh_y2013.1y.nc",
     path_obs ="NATL60/NATL/data_new/dataset_nadir_0d.nc"